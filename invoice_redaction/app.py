@@ -1,11 +1,12 @@
 from datetime import datetime
-import json
+import queue
 import sqlite3
 from pathlib import Path
 
-from flask import Flask, jsonify, request, send_from_directory
+import orjson
+from flask import Flask, Response, jsonify, request, send_from_directory
 
-from pipeline import OUT_IMG_DIR, REPORT_PATH, SUPPORTED_EXTS, process_file
+from pipeline import OUT_IMG_DIR, REPORT_PATH, SUPPORTED_EXTS, process_file, save_and_hash
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_DIR = BASE_DIR / "data"
@@ -18,54 +19,117 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 app = Flask(__name__)
 
+# Connections are reused across requests instead of reopening the database
+# file every time; a connection is only ever used by one thread at a time.
+_idle_conns: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+
+
+def init_pragmas(conn):
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    try:
+        return _idle_conns.get_nowait()
+    except queue.Empty:
+        pass
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    init_pragmas(conn)
     return conn
 
 
+def release_db(conn):
+    _idle_conns.put(conn)
+
+
 def init_db():
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            stored_path TEXT NOT NULL,
-            sha256 TEXT NOT NULL,
-            uploaded_at TEXT NOT NULL
-        )
-        """
-    )
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            document_id INTEGER NOT NULL,
-            page_num INTEGER NOT NULL,
-            language TEXT NOT NULL,
-            image_path TEXT NOT NULL,
-            FOREIGN KEY(document_id) REFERENCES documents(id)
-        )
-        """
-    )
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS detections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            page_id INTEGER NOT NULL,
-            pii_type TEXT NOT NULL,
-            text_sample TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            bbox_json TEXT NOT NULL,
-            FOREIGN KEY(page_id) REFERENCES pages(id)
-        )
-        """
-    )
-    conn.commit()
-    conn.close()
+    try:
+        # Schema setup, including the bbox_json migration below, runs in one
+        # explicit transaction so a crash part-way leaves the old layout intact.
+        with conn:
+            conn.execute("BEGIN")
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    filename TEXT NOT NULL,
+                    stored_path TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    uploaded_at TEXT NOT NULL
+                )
+                """
+            )
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS pages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_id INTEGER NOT NULL,
+                    page_num INTEGER NOT NULL,
+                    language TEXT NOT NULL,
+                    image_path TEXT NOT NULL,
+                    FOREIGN KEY(document_id) REFERENCES documents(id)
+                )
+                """
+            )
+            # Databases created before boxes were stored as columns keep them in a
+            # bbox_json TEXT column; move those rows over to the new layout.
+            columns = {row["name"] for row in cursor.execute("PRAGMA table_info(detections)")}
+            migrate_bbox_json = "bbox_json" in columns
+            if migrate_bbox_json:
+                cursor.execute("ALTER TABLE detections RENAME TO detections_bbox_json")
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS detections (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    page_id INTEGER NOT NULL,
+                    pii_type TEXT NOT NULL,
+                    text_sample TEXT NOT NULL,
+                    confidence REAL NOT NULL,
+                    x1 INTEGER NOT NULL,
+                    y1 INTEGER NOT NULL,
+                    x2 INTEGER NOT NULL,
+                    y2 INTEGER NOT NULL,
+                    FOREIGN KEY(page_id) REFERENCES pages(id)
+                )
+                """
+            )
+            if migrate_bbox_json:
+                cursor.execute(
+                    """
+                    INSERT INTO detections
+                        (id, page_id, pii_type, text_sample, confidence, x1, y1, x2, y2)
+                    SELECT
+                        id,
+                        page_id,
+                        pii_type,
+                        text_sample,
+                        confidence,
+                        json_extract(bbox_json, '$[0]'),
+                        json_extract(bbox_json, '$[1]'),
+                        json_extract(bbox_json, '$[2]'),
+                        json_extract(bbox_json, '$[3]')
+                    FROM detections_bbox_json
+                    """
+                )
+                cursor.execute("DROP TABLE detections_bbox_json")
+            # Matches the report's grouping and ordering, so the report query walks
+            # this index instead of sorting; it supersedes the single-column index.
+            cursor.execute("DROP INDEX IF EXISTS idx_pages_document_id")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pages_document_page "
+                "ON pages(document_id DESC, page_num)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_detections_page_id ON detections(page_id)"
+            )
+    finally:
+        release_db(conn)
 
 
 @app.route("/")
@@ -86,52 +150,49 @@ def redacted_image(filename):
 @app.route("/api/report")
 def report():
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT
-            documents.filename,
-            documents.stored_path,
-            documents.sha256,
-            pages.page_num,
-            pages.language,
-            pages.image_path,
-            detections.pii_type,
-            detections.text_sample,
-            detections.confidence,
-            detections.bbox_json
-        FROM pages
-        JOIN documents ON pages.document_id = documents.id
-        LEFT JOIN detections ON detections.page_id = pages.id
-        ORDER BY documents.id DESC, pages.page_num ASC
-        """
-    )
-    rows = cursor.fetchall()
-    conn.close()
-
-    report_entries = {}
-    for row in rows:
-        key = (row["stored_path"], row["page_num"])
-        if key not in report_entries:
-            report_entries[key] = {
-                "file": row["stored_path"],
-                "file_hash": row["sha256"],
-                "page": row["page_num"],
-                "language": row["language"],
-                "detections": [],
-                "image_path": row["image_path"],
-            }
-        if row["pii_type"]:
-            report_entries[key]["detections"].append(
-                {
-                    "type": row["pii_type"],
-                    "text_sample": row["text_sample"],
-                    "confidence": row["confidence"],
-                    "bbox_xyxy": json.loads(row["bbox_json"]),
-                }
-            )
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT
+                documents.stored_path,
+                documents.sha256,
+                pages.page_num,
+                pages.language,
+                pages.image_path,
+                json_group_array(
+                    json_object(
+                        'type', detections.pii_type,
+                        'text_sample', detections.text_sample,
+                        'confidence', detections.confidence,
+                        'bbox_xyxy', json_array(
+                            detections.x1, detections.y1, detections.x2, detections.y2
+                        )
+                    )
+                ) FILTER (WHERE detections.id IS NOT NULL) AS detections
+            FROM pages
+            JOIN documents ON pages.document_id = documents.id
+            LEFT JOIN detections ON detections.page_id = pages.id
+            GROUP BY pages.document_id, pages.page_num, pages.id
+            ORDER BY pages.document_id DESC, pages.page_num ASC, pages.id ASC
+            """
+        )
+        rows = cursor.fetchall()
+    finally:
+        release_db(conn)
 
-    return jsonify(list(report_entries.values()))
+    entries = [
+        {
+            "file": row["stored_path"],
+            "file_hash": row["sha256"],
+            "page": row["page_num"],
+            "language": row["language"],
+            "detections": orjson.loads(row["detections"]),
+            "image_path": row["image_path"],
+        }
+        for row in rows
+    ]
+    return Response(orjson.dumps(entries), mimetype="application/json")
 
 
 @app.route("/api/upload", methods=["POST"])
@@ -150,52 +211,61 @@ def upload():
     timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
     stored_name = f"{Path(file.filename).stem}_{timestamp}{suffix}"
     stored_path = UPLOAD_DIR / stored_name
-    file.save(stored_path)
+    file_hash = save_and_hash(file.stream, stored_path)
 
-    entries = process_file(stored_path)
+    entries = process_file(stored_path, file_hash)
 
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO documents (filename, stored_path, sha256, uploaded_at)
-        VALUES (?, ?, ?, ?)
-        """,
-        (
-            file.filename,
-            str(stored_path),
-            entries[0]["file_hash"] if entries else "",
-            datetime.utcnow().isoformat(),
-        ),
-    )
-    document_id = cursor.lastrowid
-
-    for entry in entries:
-        cursor.execute(
-            """
-            INSERT INTO pages (document_id, page_num, language, image_path)
-            VALUES (?, ?, ?, ?)
-            """,
-            (document_id, entry["page"], entry["language"], entry["image_path"]),
-        )
-        page_id = cursor.lastrowid
-        for detection in entry["detections"]:
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
             cursor.execute(
                 """
-                INSERT INTO detections (page_id, pii_type, text_sample, confidence, bbox_json)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO documents (filename, stored_path, sha256, uploaded_at)
+                VALUES (?, ?, ?, ?)
                 """,
                 (
-                    page_id,
-                    detection["type"],
-                    detection["text_sample"],
-                    detection["confidence"],
-                    json.dumps(detection["bbox_xyxy"]),
+                    file.filename,
+                    str(stored_path),
+                    file_hash,
+                    datetime.utcnow().isoformat(),
                 ),
             )
+            document_id = cursor.lastrowid
 
-    conn.commit()
-    conn.close()
+            cursor.executemany(
+                """
+                INSERT INTO pages (document_id, page_num, language, image_path)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (document_id, entry["page"], entry["language"], entry["image_path"])
+                    for entry in entries
+                ],
+            )
+            cursor.execute("SELECT id, page_num FROM pages WHERE document_id = ?", (document_id,))
+            page_ids = {row["page_num"]: row["id"] for row in cursor.fetchall()}
+
+            cursor.executemany(
+                """
+                INSERT INTO detections (page_id, pii_type, text_sample, confidence, x1, y1, x2, y2)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        page_ids[entry["page"]],
+                        detection["type"],
+                        detection["text_sample"],
+                        detection["confidence"],
+                        *detection["bbox_xyxy"],
+                    )
+                    for entry in entries
+                    for detection in entry["detections"]
+                ],
+            )
+    finally:
+        release_db(conn)
 
     return jsonify({"status": "processed", "pages": len(entries)})
 